@@ -22,7 +22,7 @@ setup(
     name='python-redis-lock',
     version='4.0.0',
     license='BSD-2-Clause',
-    description='Lock context manager implemented via redis SETNX/BLPOP.',
+    description='Lock context manager implemented via redis Lua scripts and BLPOP.',
     long_description='{}\n{}'.format(
         re.compile('^.. start-badges.*^.. end-badges', re.M | re.S).sub('', read('README.rst')),
         re.sub(':[a-z]+:`~?(.*?)`', r'``\1``', read('CHANGELOG.rst')),
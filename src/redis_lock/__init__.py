@@ -1,12 +1,18 @@
 import threading
 import weakref
 from base64 import b64encode
+from itertools import islice
 from logging import getLogger
 from os import urandom
 from typing import Union
 
 from redis import StrictRedis
 
+try:
+    from redis.commands.core import Script
+except ImportError:  # older redis releases, before Script moved to redis.commands.core
+    from redis.client import Script
+
 __version__ = '4.0.0'
 
 logger_for_acquire = getLogger(f"{__name__}.acquire")
@@ -16,6 +22,21 @@ logger_for_refresh_shutdown = getLogger(f"{__name__}.refresh.shutdown")
 logger_for_refresh_exit = getLogger(f"{__name__}.refresh.exit")
 logger_for_release = getLogger(f"{__name__}.release")
 
+# Set the key if it's free. Otherwise return an error code telling whether we already own it.
+ACQUIRE_SCRIPT = b"""
+    local owner = redis.call("get", KEYS[1])
+    if owner == ARGV[1] then
+        return 2
+    elseif owner then
+        return 1
+    elseif ARGV[2] == "0" then
+        redis.call("set", KEYS[1], ARGV[1])
+    else
+        redis.call("set", KEYS[1], ARGV[1], "ex", ARGV[2])
+    end
+    return 0
+"""
+
 # Check if the id match. If not, return an error code.
 UNLOCK_SCRIPT = b"""
     if redis.call("get", KEYS[1]) ~= ARGV[1] then
@@ -48,19 +69,21 @@ RESET_SCRIPT = b"""
     return redis.call('del', KEYS[1])
 """
 
+# Takes a batch of lock keys (found via SCAN) instead of running KEYS, which would block the server.
 RESET_ALL_SCRIPT = b"""
-    local locks = redis.call('keys', 'lock:*')
     local signal
-    for _, lock in pairs(locks) do
+    for _, lock in pairs(KEYS) do
         signal = 'lock-signal:' .. string.sub(lock, 6)
         redis.call('del', signal)
         redis.call('lpush', signal, 1)
         redis.call('expire', signal, 1)
         redis.call('del', lock)
     end
-    return #locks
+    return #KEYS
 """
 
+RESET_ALL_BATCH_SIZE = 500
+
 
 class AlreadyAcquired(RuntimeError):
     pass
@@ -92,13 +115,17 @@ class NotExpirable(RuntimeError):
 
 class Lock(object):
     """
-    A Lock context manager implemented via redis SETNX/BLPOP.
+    A Lock context manager implemented via redis Lua scripts and BLPOP.
+
+    Acquiring runs a script that checks the current owner and sets the key if it's free, all in one round-trip.
     """
 
-    unlock_script = None
-    extend_script = None
-    reset_script = None
-    reset_all_script = None
+    # Not bound to any client: every call passes its own, and redis-py reloads the script on NOSCRIPT.
+    acquire_script = Script(None, ACQUIRE_SCRIPT)
+    unlock_script = Script(None, UNLOCK_SCRIPT)
+    extend_script = Script(None, EXTEND_SCRIPT)
+    reset_script = Script(None, RESET_SCRIPT)
+    reset_all_script = Script(None, RESET_ALL_SCRIPT)
     blocking = None
 
     _lock_renewal_interval: float
@@ -170,21 +197,13 @@ class Lock(object):
 
         self.blocking = blocking
 
-        self.register_scripts(redis_client)
-
     @classmethod
     def register_scripts(cls, redis_client):
-        global reset_all_script
-        if reset_all_script is None:
-            cls.unlock_script = redis_client.register_script(UNLOCK_SCRIPT)
-            cls.extend_script = redis_client.register_script(EXTEND_SCRIPT)
-            cls.reset_script = redis_client.register_script(RESET_SCRIPT)
-            cls.reset_all_script = redis_client.register_script(RESET_ALL_SCRIPT)
-            reset_all_script = redis_client.register_script(RESET_ALL_SCRIPT)
+        """
+        Does nothing. The scripts are created at import time and aren't bound to a client anymore.
 
-    @property
-    def _held(self):
-        return self.id == self.get_owner_id()
+        Kept for backwards compatibility.
+        """
 
     def reset(self):
         """
@@ -211,9 +230,6 @@ class Lock(object):
         """
         logger_for_acquire.debug("Acquiring Lock(%r) ...", self._name)
 
-        if self._held:
-            raise AlreadyAcquired("Already acquired from this Lock instance.")
-
         if not blocking and timeout is not None:
             raise TimeoutNotUsable("Timeout cannot be used if blocking=False")
 
@@ -229,7 +245,12 @@ class Lock(object):
         blpop_timeout = timeout or self._expire or 0
         timed_out = False
         while busy:
-            busy = not self._client.set(self._name, self._id, nx=True, ex=self._expire)
+            error = self.acquire_script(client=self._client, keys=(self._name,), args=(self._id, self._expire or 0))
+            if error == 2:
+                raise AlreadyAcquired("Already acquired from this Lock instance.")
+            elif error not in (0, 1):
+                raise RuntimeError(f"Unsupported error code {error} from ACQUIRE script.")
+            busy = error == 1
             if busy:
                 if timed_out:
                     return False
@@ -363,16 +384,19 @@ class Lock(object):
         return self._client.exists(self._name) == 1
 
 
-reset_all_script = None
-
-
 def reset_all(redis_client):
     """
     Forcibly deletes all locks if its remains (like a crash reason). Use this with care.
 
+    The keys are walked with ``SCAN`` and reset in batches of ``RESET_ALL_BATCH_SIZE``, so this is not atomic: locks
+    acquired while it runs may or may not be reset.
+
     :param redis_client:
         An instance of :class:`~StrictRedis`.
     """
-    Lock.register_scripts(redis_client)
-
-    reset_all_script(client=redis_client)  # noqa
+    keys = redis_client.scan_iter(match='lock:*', count=RESET_ALL_BATCH_SIZE)
+    while True:
+        batch = list(islice(keys, RESET_ALL_BATCH_SIZE))
+        if not batch:
+            break
+        Lock.reset_all_script(client=redis_client, keys=batch)
@@ -2,4 +2,5 @@ import os
 from pathlib import Path
 
 TIMEOUT = int(os.getenv('REDIS_LOCK_TEST_TIMEOUT', 10))
+WORKERS = int(os.getenv('REDIS_LOCK_TEST_WORKERS', 125))
 HELPER = str(Path(__file__).parent / 'helper.py')
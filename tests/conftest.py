@@ -1,17 +1,35 @@
 import pytest
 from process_tests import TestProcess
 from process_tests import wait_for_strings
+from redis import StrictRedis
 
+from redis_lock import Lock
 
-@pytest.fixture
-def redis_socket(tmp_path):
-    return str(tmp_path.joinpath('redis.sock'))
 
+@pytest.fixture(scope='module')
+def redis_socket(tmp_path_factory):
+    return str(tmp_path_factory.mktemp('redis-socket').joinpath('redis.sock'))
 
-@pytest.fixture
-def redis_server(tmp_path, redis_socket):
+
+@pytest.fixture(scope='module')
+def redis_process(tmp_path_factory, redis_socket):
+    data_dir = tmp_path_factory.mktemp('redis-data')
     with TestProcess(
-        'redis-server', '--port', '0', '--save', '', '--appendonly', 'yes', '--dir', tmp_path, '--unixsocket', redis_socket
-    ) as redis_server:
-        wait_for_strings(redis_server.read, 2, 'ready to accept connections')
-        yield redis_server
+        'redis-server', '--port', '0', '--save', '', '--appendonly', 'yes', '--dir', data_dir, '--unixsocket', redis_socket
+    ) as redis_process:
+        wait_for_strings(redis_process.read, 2, 'ready to accept connections')
+        # FLUSHDB doesn't drop the script cache, so loading these once spares every test the NOSCRIPT round-trip.
+        with StrictRedis(unix_socket_path=redis_socket) as conn:
+            for script in Lock.acquire_script, Lock.unlock_script, Lock.extend_script, Lock.reset_script, Lock.reset_all_script:
+                conn.script_load(script.script)
+        yield redis_process
+
+
+@pytest.fixture
+def redis_server(redis_process, redis_socket):
+    """
+    The module's redis-server, flushed so that each test starts with an empty db.
+    """
+    with StrictRedis(unix_socket_path=redis_socket) as conn:
+        conn.flushdb()
+    return redis_process
@@ -1,22 +1,103 @@
-from __future__ import division
-from __future__ import print_function
-
 import logging
 import os
 import sys
 import threading
 import time
 
-from redis import StrictRedis
+from config import TIMEOUT
+from config import WORKERS
 
-from redis_lock import Lock
 
-from config import TIMEOUT
+def connect(redis_socket):
+    """
+    Imports redis and redis_lock on first use, so that __main__ gets to apply the effect (gevent/eventlet monkey-patching)
+    first, and binds ``Lock`` for the scenarios below.
+    """
+    global Lock
+    from redis import StrictRedis
+
+    from redis_lock import Lock
+
+    return StrictRedis(unix_socket_path=redis_socket)
+
+
+def run_test_simple(redis_socket):
+    conn = connect(redis_socket)
+    with Lock(conn, "foobar"):
+        time.sleep(0.1)
+
+
+def run_test_simple_auto_renewal(redis_socket):
+    conn = connect(redis_socket)
+    with Lock(conn, "foobar", expire=1, auto_renewal=True):
+        time.sleep(2)
+
+
+def run_test_no_block(redis_socket):
+    conn = connect(redis_socket)
+    lock = Lock(conn, "foobar")
+    res = lock.acquire(blocking=False)
+    logging.info("acquire=>%s", res)
+
+
+def run_test_timeout(redis_socket):
+    conn = connect(redis_socket)
+    with Lock(conn, "foobar"):
+        time.sleep(1)
+
+
+def run_test_expire(redis_socket):
+    conn = connect(redis_socket)
+    with Lock(conn, "foobar", expire=TIMEOUT / 4):
+        time.sleep(0.1)
+    with Lock(conn, "foobar", expire=TIMEOUT / 4):
+        time.sleep(0.1)
+
+
+def run_test_no_overlap(redis_socket):
+    # the idea is to start all the locks at the same time - every fork reports that it's ready and then blocks until the
+    # parent has seen all of them and lets them go together (a single LPUSH wakes all the BLPOPs)
+    pids = []
+
+    for _ in range(WORKERS):
+        pid = os.fork()
+        if pid:
+            pids.append(pid)
+        else:
+            try:
+                conn = connect(redis_socket)
+                conn.rpush('test_no_overlap:ready', 1)
+                conn.blpop('test_no_overlap:go', TIMEOUT)
+                with Lock(conn, "foobar"):
+                    time.sleep(0.001)
+            finally:
+                os._exit(0)
+    conn = connect(redis_socket)
+    for _ in pids:
+        conn.blpop('test_no_overlap:ready', TIMEOUT)
+    conn.lpush('test_no_overlap:go', *[1] * len(pids))
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+
+def add_monotonic_ns(record):
+    record.monotonic_ns = time.monotonic_ns()
+    return True
+
+
+DISPATCH = {
+    'test_simple': run_test_simple,
+    'test_simple_auto_renewal': run_test_simple_auto_renewal,
+    'test_no_block': run_test_no_block,
+    'test_timeout': run_test_timeout,
+    'test_expire': run_test_expire,
+    'test_no_overlap': run_test_no_overlap,
+}
 
 if __name__ == '__main__':
-    logging.basicConfig(
-        level=logging.DEBUG, format='%(process)d %(asctime)s,%(msecs)05d %(name)s %(levelname)s %(message)s', datefmt="%x~%X"
-    )
+    # Timestamps are integer nanoseconds from the monotonic clock, so they compare correctly across the forked processes.
+    logging.basicConfig(level=logging.DEBUG, format='%(process)d %(monotonic_ns)d %(name)s %(levelname)s %(message)s')
+    logging.root.handlers[0].addFilter(add_monotonic_ns)
     redis_socket = sys.argv[1]
     test_name = sys.argv[2]
     if ':' in test_name:
@@ -33,57 +114,8 @@ if __name__ == '__main__':
         else:
             raise RuntimeError('Invalid effect spec %r.' % effect)
     logging.info('threading.get_ident.__module__=%s', threading.get_ident.__module__)
-    if test_name == 'test_simple':
-        conn = StrictRedis(unix_socket_path=redis_socket)
-        with Lock(conn, "foobar"):
-            time.sleep(0.1)
-    elif test_name == 'test_simple_auto_renewal':
-        conn = StrictRedis(unix_socket_path=redis_socket)
-        with Lock(conn, "foobar", expire=1, auto_renewal=True) as lock:
-            time.sleep(2)
-    elif test_name == 'test_no_block':
-        conn = StrictRedis(unix_socket_path=redis_socket)
-        lock = Lock(conn, "foobar")
-        res = lock.acquire(blocking=False)
-        logging.info("acquire=>%s", res)
-    elif test_name == 'test_timeout':
-        conn = StrictRedis(unix_socket_path=redis_socket)
-        with Lock(conn, "foobar"):
-            time.sleep(1)
-    elif test_name == 'test_expire':
-        conn = StrictRedis(unix_socket_path=redis_socket)
-        with Lock(conn, "foobar", expire=TIMEOUT / 4):
-            time.sleep(0.1)
-        with Lock(conn, "foobar", expire=TIMEOUT / 4):
-            time.sleep(0.1)
-    elif test_name == 'test_no_overlap':
-        from sched import scheduler
-
-        sched = scheduler(time.time, time.sleep)
-        start = time.time() + TIMEOUT / 2
-
-        # the idea is to start all the lock at the same time - we use the scheduler to start everything in TIMEOUT/2 seconds, by
-        # that time all the forks should be ready
-
-        def cb_no_overlap():
-            with Lock(conn, "foobar"):
-                time.sleep(0.001)
-
-        sched.enterabs(start, 0, cb_no_overlap, ())
-        pids = []
-
-        for _ in range(125):
-            pid = os.fork()
-            if pid:
-                pids.append(pid)
-            else:
-                try:
-                    conn = StrictRedis(unix_socket_path=redis_socket)
-                    sched.run()
-                finally:
-                    os._exit(0)
-        for pid in pids:
-            os.waitpid(pid, 0)
-    else:
+    test_fn = DISPATCH.get(test_name)
+    if test_fn is None:
         raise RuntimeError('Invalid test spec %r.' % test_name)
+    test_fn(redis_socket)
     logging.info('DIED.')
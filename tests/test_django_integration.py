@@ -17,7 +17,7 @@ def redis_socket_static(tmpdir_factory):
     return path
 
 
-@pytest.fixture
+@pytest.fixture(scope='module')
 def redis_socket(redis_socket_static):
     return redis_socket_static
 
@@ -1,21 +1,20 @@
-from __future__ import division
-from __future__ import print_function
-
 import gc
 import logging
 import multiprocessing
 import platform
+import re
 import sys
 import threading
 import time
-from collections import defaultdict
 from functools import partial
 
 import pytest
 from process_tests import TestProcess
 from process_tests import dump_on_error
 from process_tests import wait_for_strings
+from redis import ConnectionPool
 from redis import StrictRedis
+from redis import UnixDomainSocketConnection
 
 from redis_lock import AlreadyAcquired
 from redis_lock import InvalidTimeout
@@ -28,26 +27,46 @@ from redis_lock import reset_all
 
 from config import HELPER
 from config import TIMEOUT
+from config import WORKERS
 
 pytest_plugins = ('pytester',)
 
 skipifpypy = partial(pytest.mark.skipif(platform.python_implementation() == 'PyPy'))
 
+# Matches helper.py log lines: "<pid> <monotonic ns> <logger> <level> Acquired Lock(...)" (or Releasing).
+LOCK_EVENT_RE = re.compile(r'^(\d+) (\d+) .*?(Acquired|Releasing) Lock\(', re.MULTILINE)
+
+# What helper.py logs for its "foobar" lock. These are str, not bytes, because TestProcess.read() returns str.
+LOCK_NAME = 'lock:foobar'
+ACQUIRING = 'Acquiring Lock(%r) ...' % LOCK_NAME
+ACQUIRED = 'Acquired Lock(%r).' % LOCK_NAME
+RELEASING = 'Releasing Lock(%r).' % LOCK_NAME
+FAILED_TO_ACQUIRE = 'Failed to acquire Lock(%r).' % LOCK_NAME
+
+# Not closing fds (ours are non-inheritable anyway) lets subprocess use posix_spawn instead of fork+exec.
+HelperProcess = partial(TestProcess, sys.executable, HELPER, close_fds=False)
 
-def maybe_decode(data):
-    if isinstance(data, bytes):
-        return data.decode('ascii')
-    else:
-        return data
+
+def ascii_equal(data, text):
+    if isinstance(data, str):
+        data = data.encode('ascii')
+    return data == text.encode('ascii')
 
 
 @pytest.fixture(params=[True, False], ids=['decode_responses=True', 'decode_responses=False'])
 def make_conn_plain(request, redis_server, redis_socket):
+    pools = {}
+
     def conn_factory(**options):
         options.setdefault('encoding_errors', 'replace')
-        conn = StrictRedis(unix_socket_path=redis_socket, **options)
-        request.addfinalizer(conn.flushdb)
-        return conn
+        # A wedged server should fail the test instead of hanging the run.
+        options.setdefault('socket_timeout', TIMEOUT)
+        key = tuple(sorted(options.items()))
+        pool = pools.get(key)
+        if pool is None:
+            pool = pools[key] = ConnectionPool(connection_class=UnixDomainSocketConnection, path=redis_socket, **options)
+            request.addfinalizer(pool.disconnect)
+        return StrictRedis(connection_pool=pool)
 
     return conn_factory
 
@@ -107,23 +126,21 @@ def test_upgrade(conn, make_conn_plain):
 
 
 def test_simple(redis_server, redis_socket, effect):
-    with TestProcess(sys.executable, HELPER, redis_socket, effect('test_simple')) as proc:
+    with HelperProcess(redis_socket, effect('test_simple')) as proc:
         with dump_on_error(proc.read):
-            name = 'lock:foobar'
             wait_for_strings(
                 proc.read,
                 TIMEOUT,
-                'Acquiring Lock(%r) ...' % name,
-                'Acquired Lock(%r).' % name,
-                'Releasing Lock(%r).' % name,
+                ACQUIRING,
+                ACQUIRED,
+                RELEASING,
                 'DIED.',
             )
 
 
 def test_simple_auto_renewal(redis_server, redis_socket, effect, LineMatcher):
-    with TestProcess(sys.executable, HELPER, redis_socket, effect('test_simple_auto_renewal')) as proc:
+    with HelperProcess(redis_socket, effect('test_simple_auto_renewal')) as proc:
         with dump_on_error(proc.read):
-            name = 'lock:foobar'
             wait_for_strings(
                 proc.read,
                 TIMEOUT,
@@ -132,29 +149,28 @@ def test_simple_auto_renewal(redis_server, redis_socket, effect, LineMatcher):
         LineMatcher(proc.read().splitlines()).fnmatch_lines(
             [
                 '* threading.get_ident.__module__=%s' % effect.expected_impl,
-                '* Acquiring Lock(%r) ...' % name,
-                '* Acquired Lock(%r).' % name,
-                '* Starting renewal thread for Lock(%r). Refresh interval: 0.6666666666666666 seconds.' % name,
-                '* Refreshing Lock(%r).' % name,
-                '* Refreshing Lock(%r).' % name,
-                '* Signaling renewal thread for Lock(%r) to exit.' % name,
-                '* Exiting renewal thread for Lock(%r).' % name,
-                '* Renewal thread for Lock(%r) exited.' % name,
-                '* Releasing Lock(%r).' % name,
+                '* ' + ACQUIRING,
+                '* ' + ACQUIRED,
+                '* Starting renewal thread for Lock(%r). Refresh interval: 0.6666666666666666 seconds.' % LOCK_NAME,
+                '* Refreshing Lock(%r).' % LOCK_NAME,
+                '* Refreshing Lock(%r).' % LOCK_NAME,
+                '* Signaling renewal thread for Lock(%r) to exit.' % LOCK_NAME,
+                '* Exiting renewal thread for Lock(%r).' % LOCK_NAME,
+                '* Renewal thread for Lock(%r) exited.' % LOCK_NAME,
+                '* ' + RELEASING,
             ]
         )
 
 
 def test_no_block(conn, redis_socket):
     with Lock(conn, "foobar"):
-        with TestProcess(sys.executable, HELPER, redis_socket, 'test_no_block') as proc:
+        with HelperProcess(redis_socket, 'test_no_block') as proc:
             with dump_on_error(proc.read):
-                name = 'lock:foobar'
                 wait_for_strings(
                     proc.read,
                     TIMEOUT,
-                    'Acquiring Lock(%r) ...' % name,
-                    'Failed to acquire Lock(%r).' % name,
+                    ACQUIRING,
+                    FAILED_TO_ACQUIRE,
                     'acquire=>False',
                     'DIED.',
                 )
@@ -187,14 +203,13 @@ def test_timeout_expire_with_renewal(conn):
 
 
 def test_timeout_acquired(conn, redis_socket):
-    with TestProcess(sys.executable, HELPER, redis_socket, 'test_timeout') as proc:
+    with HelperProcess(redis_socket, 'test_timeout') as proc:
         with dump_on_error(proc.read):
-            name = 'lock:foobar'
             wait_for_strings(
                 proc.read,
                 TIMEOUT,
-                'Acquiring Lock(%r) ...' % name,
-                'Acquired Lock(%r).' % name,
+                ACQUIRING,
+                ACQUIRED,
             )
             lock = Lock(conn, "foobar")
             assert lock.acquire(timeout=2)
@@ -243,15 +258,14 @@ def test_expire_int_conversion():
 def test_expire(conn, redis_socket):
     lock = Lock(conn, "foobar", expire=TIMEOUT / 4)
     lock.acquire()
-    with TestProcess(sys.executable, HELPER, redis_socket, 'test_expire') as proc:
+    with HelperProcess(redis_socket, 'test_expire') as proc:
         with dump_on_error(proc.read):
-            name = 'lock:foobar'
             wait_for_strings(
                 proc.read,
                 TIMEOUT,
-                'Acquiring Lock(%r) ...' % name,
-                'Acquired Lock(%r).' % name,
-                'Releasing Lock(%r).' % name,
+                ACQUIRING,
+                ACQUIRED,
+                RELEASING,
                 'DIED.',
             )
     lock = Lock(conn, "foobar")
@@ -283,11 +297,12 @@ def test_extend(conn):
 def test_extend_lock_default_expire(conn):
     name = 'foobar'
     key_name = 'lock:' + name
-    with Lock(conn, name, expire=1000) as lock:
-        time.sleep(3)
-        assert conn.ttl(key_name) <= 997
+    with Lock(conn, name, expire=10) as lock:
+        # wind the ttl back instead of sleeping it down
+        conn.pexpire(key_name, 5000)
+        assert conn.pttl(key_name) <= 5000
         lock.extend()
-        assert 997 < conn.ttl(key_name) <= 1000
+        assert 5000 < conn.pttl(key_name) <= 10000
 
 
 def test_extend_lock_without_expire_fail(conn):
@@ -341,6 +356,13 @@ def test_double_acquire(conn):
         pytest.raises(AlreadyAcquired, lock.acquire)
 
 
+def test_double_acquire_invalid_arguments(conn):
+    lock = Lock(conn, "foobar")
+    with lock:
+        # arguments are validated before the ownership check
+        pytest.raises(TimeoutNotUsable, lock.acquire, blocking=False, timeout=1)
+
+
 def test_enter_already_acquired_with_not_blocking(conn):
     lock = Lock(conn, "foobar")
     acquired = lock.acquire()
@@ -353,7 +375,7 @@ def test_enter_already_acquired_with_not_blocking(conn):
 
 def test_plain(conn):
     with Lock(conn, "foobar"):
-        time.sleep(0.01)
+        pass
 
 
 def test_no_overlap(redis_server, redis_socket):
@@ -368,85 +390,62 @@ def test_no_overlap(redis_server, redis_socket):
     got a very bad regression on our hands ...
 
     The subprocess being run (check helper.py) will fork bunch of processes and will try to
-    syncronize them (using the builting sched) to try to acquire the lock at the same time.
+    syncronize them (using a couple of redis lists) to try to acquire the lock at the same time.
     """
-    with TestProcess(sys.executable, HELPER, redis_socket, 'test_no_overlap') as proc:
+    with HelperProcess(redis_socket, 'test_no_overlap') as proc:
         with dump_on_error(proc.read):
-            name = 'lock:foobar'
-            wait_for_strings(proc.read, 10 * TIMEOUT, 'Acquiring Lock(%r) ...' % name)
-            wait_for_strings(proc.read, 10 * TIMEOUT, 'Acquired Lock(%r).' % name)
-            wait_for_strings(proc.read, 10 * TIMEOUT, 'Releasing Lock(%r).' % name)
-            wait_for_strings(proc.read, 10 * TIMEOUT, 'DIED.')
-
-            class Event(object):
-                pid = start = end = '?'
-
-                def __str__(self):
-                    return "Event(%s; %r => %r)" % (self.pid, self.start, self.end)
-
-            events = defaultdict(Event)
-            for line in proc.read().splitlines():
-                try:
-                    pid, time, junk = line.split(' ', 2)
-                    pid = int(pid)
-                except ValueError:
-                    continue
-                if 'Got lock for' in junk:
-                    events[pid].pid = pid
-                    events[pid].start = time
-                if 'Releasing' in junk:
-                    events[pid].pid = pid
-                    events[pid].end = time
-            assert len(events) == 125
-
-            # not very smart but we don't have millions of events so it's
-            # ok - compare all the events with all the other events:
-            for event in events.values():
-                for other in events.values():
-                    if other is not event:
-                        try:
-                            if other.start < event.start < other.end or other.start < event.end < other.end:
-                                pytest.fail('%s overlaps %s' % (event, other))
-                        except Exception:
-                            print("[%s/%s]" % (event, other))
-                            raise
-
-
-def _no_overlap2_workerfn(redis_socket, event, count_lock, count):
+            wait_for_strings(
+                proc.read,
+                10 * TIMEOUT,
+                ACQUIRING,
+                ACQUIRED,
+                RELEASING,
+                'DIED.',
+            )
+
+            starts = {}
+            ends = {}
+            for match in LOCK_EVENT_RE.finditer(proc.read()):
+                pid, time, action = int(match[1]), int(match[2]), match[3]
+                if action == 'Acquired':
+                    starts[pid] = time
+                else:
+                    ends[pid] = time
+            assert len(starts) == WORKERS
+            assert starts.keys() == ends.keys()
+
+            # ordered by acquire time, every holder must have released before the next one acquired
+            ordered = sorted(starts, key=starts.get)
+            for pid, other in zip(ordered, ordered[1:]):
+                if ends[pid] > starts[other]:
+                    pytest.fail('%s (%r => %r) overlaps %s (%r => %r)' % (pid, starts[pid], ends[pid], other, starts[other], ends[other]))
+
+
+def _no_overlap2_workerfn(redis_socket, barrier, count):
     logging.basicConfig(level=logging.DEBUG)
     with StrictRedis(unix_socket_path=redis_socket) as conn:
         redis_lock = Lock(conn, 'lock')
 
-        with count_lock:
-            count.value += 1
-
-        event.wait()
+        barrier.wait(TIMEOUT)
 
         if redis_lock.acquire(blocking=True):
-            with count_lock:
+            with count.get_lock():
                 count.value += 1
 
 
 @skipifpypy(reason="way too slow to run on PyPy")
 def test_no_overlap2(make_process, redis_server, redis_socket):
     """The second version of contention test, that uses multiprocessing."""
-    event = multiprocessing.Event()
-    count_lock = multiprocessing.Lock()
+    barrier = multiprocessing.Barrier(WORKERS + 1)
     count = multiprocessing.Value('H', 0)
 
-    for _ in range(125):
-        make_process(target=_no_overlap2_workerfn, args=(redis_socket, event, count_lock, count)).start()
+    for _ in range(WORKERS):
+        make_process(target=_no_overlap2_workerfn, args=(redis_socket, barrier, count)).start()
 
     # Wait until all workers will come to point when they are ready to acquire
-    # the redis lock.
-    while count.value < 125:
-        time.sleep(0.5)
-
-    # Then "count" will be used as counter of workers, which acquired
-    # redis-lock with success.
-    count.value = 0
-
-    event.set()
+    # the redis lock. The barrier releases them all at once, so it doubles as the go signal.
+    # Then "count" will be used as counter of workers, which acquired redis-lock with success.
+    barrier.wait(TIMEOUT)
 
     time.sleep(1)
 
@@ -476,6 +475,31 @@ def test_reset_all(conn):
     lock2.release()
 
 
+def test_reset_all_batches(conn, monkeypatch):
+    monkeypatch.setattr('redis_lock.RESET_ALL_BATCH_SIZE', 1)
+    names = ['foobar%s' % i for i in range(5)]
+    for name in names:
+        assert Lock(conn, name).acquire(blocking=False)
+    reset_all(conn)
+    assert conn.keys('lock:*') == []
+    for name in names:
+        assert conn.llen('lock-signal:' + name) == 1
+
+
+def test_scripts_reloaded_after_flush(conn):
+    # the module's server has the scripts preloaded, but a fresh production server won't
+    conn.script_flush()
+    lock = Lock(conn, "foobar", expire=10)
+    assert lock.acquire(blocking=False)
+    lock.extend()
+    lock.release()
+    lock.acquire(blocking=False)
+    lock.reset()
+    Lock(conn, "foobar").acquire(blocking=False)
+    reset_all(conn)
+    assert conn.keys('lock:*') == []
+
+
 def test_owner_id(conn):
     unique_identifier = "foobar-identifier"
     lock = Lock(conn, "foobar-tok", expire=TIMEOUT / 4, id=unique_identifier)
@@ -495,7 +519,7 @@ def test_token(conn):
     tok = lock.id
     assert conn.get(lock._name) is None
     lock.acquire(blocking=False)
-    assert maybe_decode(conn.get(lock._name)) == tok
+    assert ascii_equal(conn.get(lock._name), tok)
 
 
 def test_bogus_release(conn):
@@ -527,16 +551,26 @@ def test_auto_renewal_bad_values(conn):
 
 
 def test_auto_renewal(conn):
-    lock = Lock(conn, 'lock_renewal', expire=3, auto_renewal=True)
+    lock = Lock(conn, 'lock_renewal', expire=1, auto_renewal=True)
     lock.acquire()
 
     assert isinstance(lock._lock_renewal_thread, threading.Thread)
     assert not lock._lock_renewal_stop.is_set()
     assert isinstance(lock._lock_renewal_interval, float)
-    assert lock._lock_renewal_interval == 2
-
-    time.sleep(3)
-    assert maybe_decode(conn.get(lock._name)) == lock.id, "Key expired but it should have been getting renewed"
+    assert lock._lock_renewal_interval == 2 / 3
+
+    # the TTL only ever goes down unless the lock gets renewed
+    deadline = time.monotonic() + 2
+    last_ttl = conn.pttl(lock._name)
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        ttl = conn.pttl(lock._name)
+        if ttl > last_ttl:
+            break
+        last_ttl = ttl
+    else:
+        pytest.fail("Key TTL never went up, it should have been getting renewed")
+    assert ascii_equal(conn.get(lock._name), lock.id), "Key expired but it should have been getting renewed"
 
     lock.release()
     assert lock._lock_renewal_thread is None
@@ -558,7 +592,7 @@ def test_signal_expiration(conn, signal_expire, method):
     assert conn.llen('lock-signal:signal_expiration') == 0
 
 
-def test_reset_signalizes(make_conn, make_process):
+def test_reset_signalizes(make_conn):
     """Call to reset() causes LPUSH to signal key, so blocked waiters
     become unblocked."""
 
@@ -566,23 +600,24 @@ def test_reset_signalizes(make_conn, make_process):
         conn = make_conn()
         lock = Lock(conn, 'lock')
         if lock.acquire():
-            unblocked.value = 1
+            unblocked.set()
 
-    unblocked = multiprocessing.Value('B', 0)
+    unblocked = threading.Event()
     conn = make_conn()
     lock = Lock(conn, 'lock')
     lock.acquire()
 
-    worker = make_process(target=workerfn, args=(unblocked,))
+    # BLPOP releases the GIL, so a thread blocks just like a separate process would.
+    worker = threading.Thread(target=workerfn, args=(unblocked,), daemon=True)
     worker.start()
     worker.join(0.5)
     lock.reset()
     worker.join(0.5)
 
-    assert unblocked.value == 1
+    assert unblocked.is_set()
 
 
-def test_reset_all_signalizes(make_conn, make_process):
+def test_reset_all_signalizes(make_conn):
     """Call to reset_all() causes LPUSH to all signal keys, so blocked waiters
     become unblocked."""
 
@@ -591,22 +626,22 @@ def test_reset_all_signalizes(make_conn, make_process):
         lock1 = Lock(conn, 'lock1')
         lock2 = Lock(conn, 'lock2')
         if lock1.acquire() and lock2.acquire():
-            unblocked.value = 1
+            unblocked.set()
 
-    unblocked = multiprocessing.Value('B', 0)
+    unblocked = threading.Event()
     conn = make_conn()
     lock1 = Lock(conn, 'lock1')
     lock2 = Lock(conn, 'lock2')
     lock1.acquire()
     lock2.acquire()
 
-    worker = make_process(target=workerfn, args=(unblocked,))
+    worker = threading.Thread(target=workerfn, args=(unblocked,), daemon=True)
     worker.start()
     worker.join(0.5)
     reset_all(conn)
     worker.join(0.5)
 
-    assert unblocked.value == 1
+    assert unblocked.is_set()
 
 
 def test_auto_renewal_stops_after_gc(conn):
@@ -618,13 +653,7 @@ def test_auto_renewal_stops_after_gc(conn):
     del lock
     gc.collect()
 
-    slept = 0
-    interval = 0.1
-    while slept <= 5:
-        slept += interval
-        lock_renewal_thread.join(interval)
-        if not lock_renewal_thread.is_alive():
-            break
+    lock_renewal_thread.join(5)
 
     time.sleep(1.5)
 